@@ -1,21 +1,30 @@
 # bot.py
 import discord
 from discord.ext import commands
+import asyncio
+import contextlib
 import os
 import json
 import logging
 import re
 import requests
 import constants
+import logs
+from message_cache import MessageCache
+from quota import QuotaBudgeter
+from recorder import EventRecorder
 from statistics import mean
 from report import Report
 from report import State
 from unidecode import unidecode
 
+logger = logging.getLogger('modbot')
+
 
 def make_mod_help():
     mod_help = "Type `next` to see the next report and end moderation of the current report\n"
     mod_help += "Type `help` to see this message\n"
+    mod_help += "Type `coverage` to see how much of each channel is being scored\n"
     mod_help += "Reply to a report with any of the following commands\n"
     mod_help += "Here are your options moderating a report\n"
     mod_help += "`law`        incident is reported to law enforcement\n"
@@ -43,18 +52,25 @@ def de_leet(s):
 
 
 class ModBot(discord.Client):
-    def __init__(self, key, data_path):
+    def __init__(self, key, data_path, perspective_qps=1.0):
+        if not perspective_qps > 0:
+            raise Exception(f"perspective_qps must be a positive number of calls per second, got {perspective_qps!r}")
         self.data_path = data_path
         intents = discord.Intents.default()
         super().__init__(command_prefix='.', intents=intents)
         self.group_num = None
         self.mod_channels = {}  # Map from guild to the mod channel id for that guild
         self.reports = []  # List of reports
+        self.dm_sessions = {}  # Map from user id to [lock, number of messages using it] serializing that user's DMs
         self.perspective_key = key
         self.threshold = 0.8  # threshold to auto-hide a message
         self.mod_help = make_mod_help()  # makes mod help message
         self.completed_reports = []
         self.next_report_id = None
+        self.perspective_url = 'https://commentanalyzer.googleapis.com/v1alpha1/comments:analyze'
+        self.message_cache = MessageCache(10000)  # Recently seen group channel messages and their scores
+        self.quota = QuotaBudgeter(perspective_qps)  # Decides which channel messages are worth a Perspective call
+        self.recorder = None  # Set to an EventRecorder to capture traffic for loadtest.py
 
     async def on_ready(self):
         print(f'{self.user.name} has connected to Discord! It is these guilds:')
@@ -93,16 +109,67 @@ class ModBot(discord.Client):
         if message.author.id == self.user.id:
             return
 
+        if self.recorder:
+            self.record_message(message)
+
         # Check if this message was sent in a server ("guild") or if it's a DM
         if message.guild:
             await self.handle_channel_message(message)
         else:
             await self.handle_dm(message)
 
+    def record_message(self, message):
+        if not message.guild:
+            self.recorder.record("dm", message)
+        elif message.channel.name == f'group-{self.group_num}-mod':
+            self.recorder.record("mod", message)
+        elif message.channel.name == f'group-{self.group_num}':
+            self.recorder.record("channel", message)
+
     async def on_message_edit(self, before, after):
         await self.on_message(after)
 
+    async def on_raw_message_edit(self, payload):
+        # Fires before on_message_edit, so the edited message is re-cached with a fresh score
+        if payload.guild_id:
+            self.message_cache.invalidate(payload.guild_id, payload.channel_id, payload.message_id)
+
+    async def on_raw_message_delete(self, payload):
+        if payload.guild_id:
+            self.message_cache.invalidate(payload.guild_id, payload.channel_id, payload.message_id)
+
+    async def on_raw_bulk_message_delete(self, payload):
+        # Sent for channel.purge(), e.g. by $CLEAR_THIS_CHANNEL_REALLY
+        if payload.guild_id:
+            for message_id in payload.message_ids:
+                self.message_cache.invalidate(payload.guild_id, payload.channel_id, message_id)
+
+    async def on_guild_channel_delete(self, channel):
+        self.message_cache.invalidate_channel(channel.guild.id, channel.id)
+
+    @contextlib.asynccontextmanager
+    async def dm_session(self, key):
+        '''
+        Processes one user's DMs (or one mod channel's messages) strictly in the order they arrived, while
+        different users run concurrently. The lock is dropped once no message for that key is waiting on it.
+        '''
+        session = self.dm_sessions.get(key)
+        if session is None:
+            session = self.dm_sessions[key] = [asyncio.Lock(), 0]
+        session[1] += 1
+        try:
+            async with session[0]:
+                yield
+        finally:
+            session[1] -= 1
+            if session[1] == 0:
+                del self.dm_sessions[key]
+
     async def handle_dm(self, message):
+        async with self.dm_session(message.author.id):
+            await self.handle_report_dm(message)
+
+    async def handle_report_dm(self, message):
         # Handle a help message
         if message.content == constants.HELP_KEYWORD:
             reply = "Use the `report` command to begin the reporting process.\n"
@@ -130,21 +197,29 @@ class ModBot(discord.Client):
 
         # Finds the report belonging to author
         # Note that each client can only have one report
-        report_index = None
-        for i in range(len(self.reports)):
-            if self.reports[i].reporter.id == author.id and self.reports[i].state != State.AWAITING_MODERATION:
-                report_index = i
+        # Hold on to the report itself rather than its index: other users and the mods change the list while we await
+        report = None
+        for r in self.reports:
+            if r.reporter.id == author.id and r.state != State.AWAITING_MODERATION:
+                report = r
                 break
 
         # Let the report class handle this message; forward all the messages it returns to us
-        responses = await self.reports[report_index].handle_message(message)
+        responses = await report.handle_message(message)
         for r in responses:
             await message.channel.send(r)
 
         # If the report is complete or cancelled, remove it from our map
-        if self.reports[report_index].report_complete():
-            self.completed_reports.append(self.reports[report_index])
-            self.reports.pop(report_index)
+        # Reports compare by priority, so match on identity; moderation may already have archived it
+        if report.report_complete() and any(r is report for r in self.reports):
+            self.completed_reports.append(report)
+            self.reports = [r for r in self.reports if r is not report]
+
+    def moderation_queue(self):
+        '''
+        Reports that have been submitted. Reports still being filled in over DM have no message yet.
+        '''
+        return [report for report in self.reports if report.state == State.AWAITING_MODERATION]
 
     async def handle_mod_message(self, message):
         # remove completed reports
@@ -157,25 +232,31 @@ class ModBot(discord.Client):
             await message.channel.send(self.mod_help)
             return
 
+        if message.content == "coverage":
+            channel_names = {channel.id: channel.name for guild in self.guilds for channel in guild.text_channels}
+            await message.channel.send(self.quota.report(channel_names))
+            return
+
         if message.content == "next":
             # archive last report
             if self.next_report_id:
-                for report in self.reports:
+                for report in self.moderation_queue():
                     if report.reported_message.id == self.next_report_id:
                         await report.end_moderation()
                         self.next_report_id = None
                         break
 
-            if not self.reports:
+            queue = sorted(self.moderation_queue(), reverse=True, key=Report.get_priority)
+            if not queue:
                 self.next_report_id = None
                 return await message.channel.send("There are no reports to moderate")
-            self.reports = sorted(self.reports, reverse=True, key=Report.get_priority)
-            print(["Msg: " + report.reported_message.content + ", Pri: " + str(report.get_priority()) for report in self.reports])
-            self.next_report_id = self.reports[0].reported_message.id
-            [await rep.bump() for rep in self.reports if rep.reported_message.id == self.reports[0].reported_message.id]
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("report queue", extra={'queue': [{'message_id': report.reported_message.id, 'priority': report.get_priority()} for report in queue]})
+            self.next_report_id = queue[0].reported_message.id
+            [await rep.bump() for rep in queue if rep.reported_message.id == queue[0].reported_message.id]
             return
 
-        for report in self.reports:
+        for report in self.moderation_queue():
             if self.next_report_id == report.reported_message.id:
                 await report.moderate(message)
                 return
@@ -183,14 +264,21 @@ class ModBot(discord.Client):
     async def handle_channel_message(self, message):
         # Allow the bot to take input from the mods
         if message.channel.name == f'group-{self.group_num}-mod':
-            return await self.handle_mod_message(message)
+            async with self.dm_session(message.channel.id):
+                return await self.handle_mod_message(message)
 
         # Don't handle messages not sent in the "group-#" channel
         if message.channel.name == f'group-{self.group_num}':
             await self.moderate_message(message)
 
     async def moderate_message(self, message):
+        # Low-risk channels are only sampled, and nothing is scored once the QPS budget is spent
+        if not self.quota.acquire(message):
+            self.message_cache.put(message)
+            return
         eval = self.eval_text(message)
+        self.message_cache.put(message, eval)
+        self.quota.record(message, eval[0] >= self.threshold)
         if eval[0] >= self.threshold:
             report = Report(self, self.user)
             await report.automoderate(message, eval)
@@ -200,9 +288,7 @@ class ModBot(discord.Client):
         '''
         Given a message, forwards the message to Perspective and returns a dictionary of scores.
         '''
-        PERSPECTIVE_URL = 'https://commentanalyzer.googleapis.com/v1alpha1/comments:analyze'
-
-        url = PERSPECTIVE_URL + '?key=' + self.perspective_key
+        url = self.perspective_url + '?key=' + self.perspective_key
         data_dict = {
             'comment': {'text': de_leet(unidecode(message.content))},
             'languages': ['en'],
@@ -219,12 +305,11 @@ class ModBot(discord.Client):
         scores = {}
         for attr in response_dict["attributeScores"]:
             scores[attr] = response_dict["attributeScores"][attr]["summaryScore"]["value"]
-        print("message: ", message.content)
 
         score_list = [score for attr, score in scores.items()]
         max_pos_variation = max(max(score_list) - 0.5, 0)  # highest variation above average
         score = max(mean(score_list) + max_pos_variation / len(score_list), 0)  # average score + penalty for above average score, floored @ 0
-        print("score: ", round(score, 2))
+        logger.debug("scored message", extra={'message_id': message.id, 'score': round(score, 2)})
         return score, constants.AUTO_KEYWORD, constants.AUTO_KEYWORD
 
     def code_format(self, text):
@@ -236,12 +321,8 @@ class ModBot(discord.Client):
 
 
 def main():
-    # Set up logging to the console
-    logger = logging.getLogger('discord')
-    logger.setLevel(logging.DEBUG)
-    handler = logging.FileHandler(filename='discord.log', encoding='utf-8', mode='w')
-    handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
-    logger.addHandler(handler)
+    # Set up logging to a rotating file, written from a background thread
+    listener = logs.setup_logging(filename='discord.log')
 
     # There should be a file called 'token.json' inside the same folder as this file
     token_path = 'tokens.json'
@@ -252,10 +333,19 @@ def main():
         tokens = json.load(f)
         discord_token = tokens['discord']
         perspective_key = tokens['perspective']
+        perspective_qps = tokens.get('perspective_qps', 1.0)
 
     # Create and run bot
-    client = ModBot(perspective_key, "data.json")
-    client.run(discord_token)
+    client = ModBot(perspective_key, "data.json", perspective_qps)
+    # Set MODBOT_RECORD to a file to capture traffic that loadtest.py can replay
+    if os.environ.get('MODBOT_RECORD'):
+        client.recorder = EventRecorder(os.environ['MODBOT_RECORD'])
+    try:
+        client.run(discord_token)
+    finally:
+        if client.recorder:
+            client.recorder.close()
+        listener.stop()
 
 
 if __name__ == "__main__":
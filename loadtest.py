@@ -0,0 +1,468 @@
+# loadtest.py
+'''
+Replays a recorded or synthetic stream of Discord events through ModBot without Discord or Perspective.
+
+Guilds, channels, users and messages are replaced by small fake objects, and Perspective is replaced by a
+local HTTP server. Events are dispatched to `ModBot.on_message` at a configurable multiple of real time and
+the end-to-end throughput, latency percentiles and memory growth are reported. With `--reporters`, thousands of
+users run the whole DM reporting flow at once and every resulting report is checked for consistency.
+
+    python loadtest.py --events 5000 --speed 20
+    python loadtest.py --events 5000 --record stream.jsonl
+    python loadtest.py --replay stream.jsonl --speed 100 --perspective-latency 0.05
+    MODBOT_RECORD=live.jsonl python bot.py; python loadtest.py --replay live.jsonl
+    python loadtest.py --reporters 5000
+'''
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from statistics import median, quantiles
+
+from bot import ModBot
+from report import State
+
+GROUP_NUM = 1
+GUILD_ID = 1
+CHANNEL_ID = 10
+MOD_CHANNEL_ID = 11
+BOT_ID = 100
+MOD_ID = 101
+FIRST_USER_ID = 1000
+
+TOXIC_WORDS = ["idiot", "stupid", "hate", "kill", "ugly", "loser"]
+CLEAN_WORDS = ["hello", "storm", "weather", "lunch", "meeting", "game", "music", "today", "thanks", "great"]
+ATTRIBUTES = ['SEVERE_TOXICITY', 'PROFANITY', 'IDENTITY_ATTACK', 'THREAT', 'TOXICITY', 'FLIRTATION']
+
+
+async def network_call(world):
+    # Yield like a real network call would, so concurrent handlers interleave
+    await asyncio.sleep(random.random() * world.network_latency)
+
+
+class FakeUser:
+    def __init__(self, world, id, name):
+        self.world = world
+        self.id = id
+        self.name = name
+        self.sent = 0
+
+    async def send(self, content):
+        await network_call(self.world)
+        self.sent += 1
+
+
+class FakeMessage:
+    def __init__(self, id, content, author, channel):
+        self.id = id
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.guild = channel.guild
+        self.reactions = set()
+
+    async def add_reaction(self, emoji):
+        self.reactions.add(emoji)
+
+    async def clear_reactions(self):
+        self.reactions.clear()
+
+
+class FakeChannel:
+    def __init__(self, world, id, name, guild=None):
+        self.world = world
+        self.id = id
+        self.name = name
+        self.guild = guild
+        self.sent = 0
+
+    async def send(self, content):
+        await network_call(self.world)
+        self.sent += 1
+        return FakeMessage(self.world.next_id(), content, self.world.bot_user, self)
+
+    async def fetch_message(self, id):
+        await network_call(self.world)
+        return self.world.messages[id]
+
+    async def purge(self):
+        pass
+
+
+class FakeGuild:
+    def __init__(self, id, name):
+        self.id = id
+        self.name = name
+        self.text_channels = []
+
+    def get_channel(self, id):
+        for channel in self.text_channels:
+            if channel.id == id:
+                return channel
+        return None
+
+
+class World:
+    '''
+    Holds the fake guild, channels and users and turns recorded events into fake messages.
+    '''
+    def __init__(self, network_latency=0.0):
+        self.network_latency = network_latency
+        self.bot_user = FakeUser(self, BOT_ID, f"Group {GROUP_NUM} Bot")
+        self.mod_user = FakeUser(self, MOD_ID, "mod")
+        self.guild = FakeGuild(GUILD_ID, f"group-{GROUP_NUM}-guild")
+        self.channel = FakeChannel(self, CHANNEL_ID, f"group-{GROUP_NUM}", self.guild)
+        self.mod_channel = FakeChannel(self, MOD_CHANNEL_ID, f"group-{GROUP_NUM}-mod", self.guild)
+        self.guild.text_channels = [self.channel, self.mod_channel]
+        self.guilds = [self.guild]
+        self.users = {}
+        self.dm_channels = {}
+        self.messages = {}
+        self._next_id = 10 ** 9
+
+    def next_id(self):
+        self._next_id += 1
+        return self._next_id
+
+    def user(self, id):
+        if id == MOD_ID:
+            return self.mod_user
+        if id not in self.users:
+            self.users[id] = FakeUser(self, id, f"user{id}")
+            self.dm_channels[id] = FakeChannel(self, id, f"dm-{id}")
+        return self.users[id]
+
+    def make_message(self, event):
+        author = self.user(event["author"])
+        if event["kind"] == "channel":
+            channel = self.channel
+        elif event["kind"] == "mod":
+            channel = self.mod_channel
+        else:
+            channel = self.dm_channels[author.id]
+        message = FakeMessage(event["id"], event["content"], author, channel)
+        if event["kind"] == "channel":
+            self.messages[message.id] = message
+        return message
+
+
+class HarnessBot(ModBot):
+    '''
+    ModBot wired to a World instead of a gateway connection.
+    '''
+    user = None
+
+    def __init__(self, world, perspective_url, perspective_qps):
+        super().__init__("loadtest", None, perspective_qps)
+        self.world = world
+        self.user = world.bot_user
+        self.perspective_url = perspective_url
+
+    @property
+    def guilds(self):
+        return self.world.guilds
+
+    def get_guild(self, id):
+        for guild in self.world.guilds:
+            if guild.id == id:
+                return guild
+        return None
+
+
+def fake_score(text):
+    '''
+    A deterministic stand-in for Perspective: toxic words push every attribute up, everything else
+    gets a small hash-based score.
+    '''
+    words = text.lower().split()
+    toxic = sum(word in TOXIC_WORDS for word in words)
+    scores = {}
+    for attr in ATTRIBUTES:
+        noise = hashlib.md5((attr + text).encode()).digest()[0] / 255 * 0.2
+        scores[attr] = min(1.0, noise + toxic * 0.5)
+    return scores
+
+
+def start_perspective(latency):
+    '''
+    Starts a local HTTP server that answers Perspective `comments:analyze` requests after `latency` seconds.
+    Returns the server and its url.
+    '''
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            if latency:
+                time.sleep(latency)
+            scores = fake_score(body['comment']['text'])
+            response = {"attributeScores": {attr: {"summaryScore": {"value": value, "type": "PROBABILITY"}}
+                                            for attr, value in scores.items()}}
+            data = json.dumps(response).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1alpha1/comments:analyze"
+
+
+def synthetic_events(n, rate=50.0, users=200, toxic_rate=0.05, report_rate=0.02, mod_every=200, seed=0):
+    '''
+    Builds a stream of about `n` events arriving at `rate` events per second of recorded time.
+    Most events are channel messages; some of them start a full DM reporting flow and a moderator
+    periodically pulls and hides the next report.
+    '''
+    rnd = random.Random(seed)
+    events = []
+    next_id = 1
+    t = 0.0
+    step = 1 / rate
+    count = 0
+    while count < n:
+        t += rnd.expovariate(rate)
+        author = FIRST_USER_ID + rnd.randrange(users)
+        words = rnd.choices(CLEAN_WORDS, k=rnd.randint(3, 12))
+        if rnd.random() < toxic_rate:
+            words[rnd.randrange(len(words))] = rnd.choice(TOXIC_WORDS)
+        message_id = next_id
+        next_id += 1
+        events.append({"t": t, "kind": "channel", "author": author, "id": message_id, "content": " ".join(words)})
+        count += 1
+
+        if rnd.random() < report_rate:
+            reporter = FIRST_USER_ID + rnd.randrange(users)
+            link = f"https://discord.com/channels/{GUILD_ID}/{CHANNEL_ID}/{message_id}"
+            flow = ["report", link, str(rnd.randint(1, 6)), "1", "please look at this", "yes"]
+            for i, content in enumerate(flow):
+                events.append({"t": t + (i + 1) * 20 * step, "kind": "dm", "author": reporter, "id": next_id,
+                               "content": content})
+                next_id += 1
+            count += len(flow)
+
+        if mod_every and count // mod_every != (count - 1) // mod_every:
+            for i, content in enumerate(["next", "m_hide"]):
+                events.append({"t": t + i * step, "kind": "mod", "author": MOD_ID, "id": next_id, "content": content})
+                next_id += 1
+            count += 2
+
+    events.sort(key=lambda event: event["t"])
+    return events
+
+
+def reporter_events(n, seed=0, step_interval=0.01):
+    '''
+    Builds a stress stream where `n` users each report a different message. The flows are interleaved step by
+    step and every event of a step arrives at the same instant, so all reporters are mid-flow concurrently.
+    Every third reporter cancels a first attempt, so reports are also being removed while others are in flight.
+    After each step a moderator takes the `next` report and hides its message, so the queue is worked while
+    reports are still being filled in.
+    '''
+    rnd = random.Random(seed)
+    events = []
+    for i in range(n):
+        words = rnd.choices(CLEAN_WORDS, k=rnd.randint(3, 12))
+        events.append({"t": 0.0, "kind": "channel", "author": FIRST_USER_ID + n + i, "id": i + 1, "content": " ".join(words)})
+    flows = []
+    for i in range(n):
+        flow = ["report", f"https://discord.com/channels/{GUILD_ID}/{CHANNEL_ID}/{i + 1}",
+                str(i % 6 + 1), "1", f"comment from reporter {i}", "yes"]
+        if i % 3 == 0:
+            flow = ["report", "cancel"] + flow
+        flows.append(flow)
+    next_id = n + 1
+    for step in range(max(len(flow) for flow in flows)):
+        for i, flow in enumerate(flows):
+            if step < len(flow):
+                events.append({"t": step * step_interval, "kind": "dm", "author": FIRST_USER_ID + i, "id": next_id,
+                               "content": flow[step]})
+                next_id += 1
+        for content in ["next", "m_hide"]:
+            events.append({"t": step * step_interval, "kind": "mod", "author": MOD_ID, "id": next_id, "content": content})
+            next_id += 1
+    return events
+
+
+def check_reports(bot, events):
+    '''
+    Checks that every user who finished a DM reporting flow ended up with exactly one report for the message
+    they linked, either awaiting moderation or already moderated. Returns a list of problems.
+    '''
+    flows = {}
+    for event in events:
+        if event["kind"] == "dm":
+            flows.setdefault(event["author"], []).append(event["content"])
+    problems = []
+    for author, contents in flows.items():
+        if contents[-1] != "yes" or "report" not in contents:
+            continue
+        link = contents[len(contents) - 1 - contents[::-1].index("report") + 1]
+        message_id = int(link.rsplit("/", 1)[1])
+        open_reports = [report for report in bot.reports if report.reporter.id == author]
+        moderated = [report for report in bot.completed_reports
+                     if report.reporter.id == author and report.reported_message is not None]
+        reports = open_reports + moderated
+        if len(reports) != 1:
+            problems.append(f"user {author} has {len(reports)} reports")
+        elif reports[0].reported_message is None or reports[0].reported_message.id != message_id:
+            problems.append(f"user {author} reported the wrong message")
+        elif open_reports and reports[0].state != State.AWAITING_MODERATION or reports[0].comment != contents[-2]:
+            problems.append(f"user {author} report is in state {reports[0].state.name}")
+    return problems
+
+
+def load_events(path):
+    '''
+    Reads a JSONL event stream. Streams captured from a live bot (see recorder.py) also carry guild and channel
+    ids; links to messages in the recorded group channels are rewritten to point at the fake guild.
+    '''
+    with open(path) as f:
+        events = [json.loads(line) for line in f if line.strip()]
+    group_channels = {(event["guild"], event["channel"]) for event in events
+                      if event["kind"] == "channel" and "guild" in event}
+
+    def relink(m):
+        if (int(m.group(1)), int(m.group(2))) in group_channels:
+            return f"/{GUILD_ID}/{CHANNEL_ID}/{m.group(3)}"
+        return m.group(0)
+
+    if group_channels:
+        for event in events:
+            if event["kind"] == "dm":
+                event["content"] = re.sub(r'/(\d+)/(\d+)/(\d+)', relink, event["content"])
+    return events
+
+
+def save_events(events, path):
+    with open(path, 'w') as f:
+        for event in events:
+            f.write(json.dumps(event) + "\n")
+
+
+async def replay(bot, events, speed=1.0, sample_interval=1.0):
+    '''
+    Dispatches every event to `bot.on_message` at `speed` times the recorded rate, each in its own task
+    as the gateway would. Returns per-event latencies (measured from the scheduled time, so loop lag
+    counts), the wall-clock duration and (seconds, bytes) memory samples.
+    '''
+    loop = asyncio.get_running_loop()
+    latencies = []
+    errors = []
+    memory = []
+
+    async def run(message, scheduled):
+        try:
+            await bot.on_message(message)
+        except Exception as e:
+            errors.append(e)
+        latencies.append(loop.time() - scheduled)
+
+    async def sample():
+        while True:
+            memory.append((loop.time() - start, tracemalloc.get_traced_memory()[0]))
+            await asyncio.sleep(sample_interval)
+
+    start = loop.time()
+    sampler = asyncio.create_task(sample())
+    tasks = []
+    for event in events:
+        scheduled = start + event["t"] / speed
+        delay = scheduled - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        message = bot.world.make_message(event)
+        tasks.append(asyncio.create_task(run(message, scheduled)))
+    await asyncio.gather(*tasks)
+    duration = loop.time() - start
+    sampler.cancel()
+    memory.append((duration, tracemalloc.get_traced_memory()[0]))
+    return latencies, errors, duration, memory
+
+
+def print_summary(latencies, errors, duration, memory, bot):
+    print(f"events:       {len(latencies)} ({len(errors)} raised)")
+    print(f"duration:     {duration:.2f}s")
+    print(f"throughput:   {len(latencies) / duration:.1f} msgs/sec")
+    if len(latencies) >= 2:
+        print(f"latency p50:  {median(latencies) * 1000:.1f} ms")
+        print(f"latency p99:  {quantiles(latencies, n=100)[98] * 1000:.1f} ms")
+        print(f"latency max:  {max(latencies) * 1000:.1f} ms")
+    print(f"reports:      {len(bot.reports)} open, {len(bot.completed_reports)} completed")
+    print(f"msg cache:    {bot.message_cache.hits} hits, {bot.message_cache.misses} misses")
+    print(f"coverage:     {bot.quota.coverage():.1%} of channel messages scored, "
+          f"{sum(bot.quota.guild_spend.values())} Perspective calls")
+    print("memory:")
+    for t, size in memory:
+        print(f"  {t:8.2f}s  {size / 2 ** 20:8.2f} MB")
+    if memory:
+        print(f"memory growth: {(memory[-1][1] - memory[0][1]) / 2 ** 20:.2f} MB")
+    if errors:
+        print(f"first error:  {errors[0]!r}")
+
+
+async def run_loadtest(events, speed, perspective_latency, network_latency, perspective_qps, sample_interval,
+                       check=False):
+    server, url = start_perspective(perspective_latency)
+    try:
+        world = World(network_latency)
+        bot = HarnessBot(world, url, perspective_qps)
+        await bot.on_ready()
+        tracemalloc.start()
+        latencies, errors, duration, memory = await replay(bot, events, speed, sample_interval)
+        tracemalloc.stop()
+        print_summary(latencies, errors, duration, memory, bot)
+        if check:
+            problems = check_reports(bot, events)
+            print(f"consistency:  {'ok' if not problems else f'{len(problems)} problems'}")
+            for problem in problems[:10]:
+                print(f"  {problem}")
+    finally:
+        server.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay Discord events through ModBot and report throughput")
+    parser.add_argument("--replay", help="JSONL file of recorded events to replay")
+    parser.add_argument("--record", help="write the synthetic stream to this JSONL file instead of running it")
+    parser.add_argument("--events", type=int, default=1000, help="number of synthetic events")
+    parser.add_argument("--rate", type=float, default=50.0, help="synthetic events per second of recorded time")
+    parser.add_argument("--users", type=int, default=200, help="number of synthetic users")
+    parser.add_argument("--reporters", type=int, help="stress test this many concurrent reporters instead")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--speed", type=float, default=1.0, help="multiple of real time to replay at")
+    parser.add_argument("--perspective-latency", type=float, default=0.0, help="seconds the stand-in takes to answer")
+    parser.add_argument("--qps", type=float, default=1000.0, help="Perspective QPS budget given to the bot")
+    parser.add_argument("--network-latency", type=float, default=0.0,
+                        help="maximum seconds a fake Discord API call takes, drawn uniformly")
+    parser.add_argument("--sample-interval", type=float, default=1.0, help="seconds between memory samples")
+    args = parser.parse_args()
+
+    if args.replay:
+        events = load_events(args.replay)
+    elif args.reporters:
+        events = reporter_events(args.reporters, seed=args.seed)
+    else:
+        events = synthetic_events(args.events, rate=args.rate, users=args.users, seed=args.seed)
+
+    if args.record:
+        save_events(events, args.record)
+        print(f"Wrote {len(events)} events to {args.record}")
+        return
+
+    asyncio.run(run_loadtest(events, args.speed, args.perspective_latency, args.network_latency, args.qps,
+                            args.sample_interval, check=bool(args.reporters)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+# logs.py
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import time
+
+
+class JsonFormatter(logging.Formatter):
+    '''
+    Formats a log record as a single line of JSON. Any extra fields passed to the logger
+    through `extra=` are included alongside the standard ones.
+    '''
+    STANDARD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in self.STANDARD_ATTRS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry['stack'] = self.formatStack(record.stack_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class SamplingFilter(logging.Filter):
+    '''
+    Lets through only a fraction of records at or below `level`. Higher levels always pass.
+    Used to keep high volume debug events (e.g. every gateway event) from flooding the log.
+    '''
+    def __init__(self, rate, level=logging.DEBUG):
+        super().__init__()
+        self.rate = rate
+        self.level = level
+
+    def filter(self, record):
+        if record.levelno > self.level or self.rate >= 1:
+            return True
+        return random.random() < self.rate
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    '''
+    Enqueues records untouched. The stock QueueHandler formats the message (and drops exc_info) on the
+    calling thread so records can be pickled; this queue never leaves the process, so all formatting is
+    left to the listener thread instead of the event loop.
+    '''
+    def prepare(self, record):
+        return record
+
+
+class RotatingFileHandler(logging.handlers.TimedRotatingFileHandler):
+    '''
+    A file handler that rolls over when the file reaches `max_bytes` or when the time interval
+    has elapsed, whichever comes first.
+    '''
+    def __init__(self, filename, max_bytes=0, when='midnight', backup_count=5, encoding='utf-8'):
+        super().__init__(filename, when=when, backupCount=backup_count, encoding=encoding, delay=True)
+        self.max_bytes = max_bytes
+
+    def shouldRollover(self, record):
+        if super().shouldRollover(record):
+            return True
+        if self.max_bytes <= 0:
+            return False
+        if self.stream is None:
+            self.stream = self._open()
+        msg = self.format(record) + self.terminator
+        return self.stream.tell() + len(msg.encode(self.encoding or 'utf-8')) >= self.max_bytes
+
+    def getFilesToDelete(self):
+        # Size based rollovers give suffixes that don't sort chronologically by name, so order backups
+        # by when they were last written to.
+        dir_name, base_name = os.path.split(self.baseFilename)
+        prefix = base_name + '.'
+        result = [os.path.join(dir_name, f) for f in os.listdir(dir_name or '.') if f.startswith(prefix)]
+        result.sort(key=lambda path: (os.path.getmtime(path), path))
+        if len(result) <= self.backupCount:
+            return []
+        return result[:len(result) - self.backupCount]
+
+    def rotation_filename(self, default_name):
+        # Make sure two rollovers inside the same time interval don't overwrite each other
+        name = super().rotation_filename(default_name)
+        if not os.path.exists(name):
+            return name
+        stamp = time.strftime('%H%M%S')
+        i = 0
+        while os.path.exists(f'{name}.{stamp}.{i}'):
+            i += 1
+        return f'{name}.{stamp}.{i}'
+
+
+def setup_logging(filename='discord.log', level=logging.INFO, max_bytes=10 * 1024 * 1024, when='midnight',
+                  backup_count=5, debug_sample_rate=0.1, loggers=('discord', 'modbot'), debug_loggers=('modbot',)):
+    '''
+    Routes the given loggers through a queue so that the event loop only enqueues records. A background
+    thread formats them as JSON and writes them to a rotating file. Loggers in `debug_loggers` log at
+    DEBUG with debug records sampled at `debug_sample_rate`; the rest log at `level`. discord.py logs every
+    gateway payload at DEBUG, so it's left at INFO by default to keep record creation off the event loop.
+    Returns the listener; call `stop()` on it to flush the queue on shutdown.
+    '''
+    log_queue = queue.SimpleQueue()
+
+    file_handler = RotatingFileHandler(filename, max_bytes=max_bytes, when=when, backup_count=backup_count)
+    file_handler.setFormatter(JsonFormatter())
+    listener = logging.handlers.QueueListener(log_queue, file_handler, respect_handler_level=True)
+
+    queue_handler = LazyQueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter(debug_sample_rate))
+    for name in loggers:
+        logger = logging.getLogger(name)
+        logger.setLevel(logging.DEBUG if name in debug_loggers else level)
+        logger.addHandler(queue_handler)
+        logger.propagate = False
+
+    listener.start()
+    return listener
@@ -0,0 +1,47 @@
+# message_cache.py
+from collections import OrderedDict
+
+
+class CachedMessage:
+    def __init__(self, message, eval=None):
+        self.message = message
+        self.eval = eval  # The (severity, type, subtype) tuple from eval_text, if it was scored
+
+
+class MessageCache:
+    '''
+    A bounded LRU cache of recently seen messages keyed by (guild id, channel id, message id).
+    Lets reports resolve pasted message links without a REST fetch and without scoring the message again.
+    '''
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def put(self, message, eval=None):
+        key = (message.guild.id, message.channel.id, message.id)
+        self.entries[key] = CachedMessage(message, eval)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def get(self, guild_id, channel_id, message_id):
+        key = (guild_id, channel_id, message_id)
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry
+
+    def invalidate(self, guild_id, channel_id, message_id):
+        self.entries.pop((guild_id, channel_id, message_id), None)
+
+    def invalidate_channel(self, guild_id, channel_id):
+        for key in [key for key in self.entries if key[0] == guild_id and key[1] == channel_id]:
+            del self.entries[key]
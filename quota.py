@@ -0,0 +1,149 @@
+# quota.py
+import asyncio
+import random
+import time
+
+
+class TokenBucket:
+    '''
+    Refills at `rate` tokens per second up to `capacity`.
+    '''
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def available(self, n=1):
+        self.refill()
+        return self.tokens >= n
+
+    def try_take(self, n=1):
+        self.refill()
+        if self.tokens >= n:
+            self.tokens -= n
+            return True
+        return False
+
+    def wait_time(self, n=1):
+        self.refill()
+        return max(0.0, (n - self.tokens) / self.rate)
+
+
+class ChannelStats:
+    def __init__(self, initial_violation_rate):
+        self.seen = 0  # Messages seen in the channel
+        self.scored = 0  # Seen messages sent to Perspective
+        self.required = 0  # Messages scored on demand, e.g. because a user reported them
+        self.sampled_out = 0  # Messages skipped because of the channel's sample rate
+        self.throttled = 0  # Messages skipped because the QPS budget was spent
+        self.violations = 0  # Scored messages at or above the threshold
+        self.violation_rate = initial_violation_rate  # Moving average of violations among scored messages
+
+
+class QuotaBudgeter:
+    '''
+    Decides which group channel messages get scored by Perspective.
+
+    All scoring shares one token bucket sized to the Perspective QPS quota. Each channel is sampled at a rate
+    proportional to its recent violation rate: channels at or above `high_risk_rate` are fully covered, quiet
+    channels drop towards `min_sample_rate`. New channels start fully covered until they earn a lower rate.
+
+    Sampled channels also draw from a second bucket refilling at `1 - reserve` of the quota, so a busy quiet
+    channel can never spend the `reserve` share that fully covered channels rely on.
+    '''
+    def __init__(self, qps=1.0, burst=None, min_sample_rate=0.1, high_risk_rate=0.05, decay=0.02, reserve=0.5):
+        self.bucket = TokenBucket(qps, burst)
+        self.sampled_bucket = TokenBucket(qps * (1 - reserve), burst)  # Caps what sampled channels may spend
+        self.reserve = reserve
+        self.min_sample_rate = min_sample_rate
+        self.high_risk_rate = high_risk_rate
+        self.decay = decay  # Weight of the newest scored message in the moving violation rate
+        self.channels = {}  # Map from (guild id, channel id) to ChannelStats
+        self.guild_spend = {}  # Map from guild id to number of Perspective calls made for it
+        self.waiting = 0  # Required calls queued for a token; sampled scoring yields to them
+        self.wait_lock = asyncio.Lock()
+
+    def stats(self, message):
+        key = (message.guild.id if message.guild else None, message.channel.id)
+        if key not in self.channels:
+            self.channels[key] = ChannelStats(self.high_risk_rate)
+        return self.channels[key]
+
+    def sample_rate(self, stats):
+        return min(1.0, max(self.min_sample_rate, stats.violation_rate / self.high_risk_rate))
+
+    def spend(self, message):
+        guild_id = message.guild.id if message.guild else None
+        self.guild_spend[guild_id] = self.guild_spend.get(guild_id, 0) + 1
+
+    def acquire(self, message):
+        '''
+        Returns whether `message` should be scored, spending quota if so.
+        '''
+        stats = self.stats(message)
+        stats.seen += 1
+        rate = self.sample_rate(stats)
+        if random.random() >= rate:
+            stats.sampled_out += 1
+            return False
+        sampled = rate < 1.0
+        if self.waiting or (sampled and not self.sampled_bucket.available()) or not self.bucket.try_take():
+            stats.throttled += 1
+            return False
+        if sampled:
+            self.sampled_bucket.try_take()
+        stats.scored += 1
+        self.spend(message)
+        return True
+
+    async def acquire_required(self, message):
+        '''
+        Waits for quota to score a message that must be scored, e.g. because a user reported it.
+        Required messages queue in order and take precedence over sampled channel messages.
+        '''
+        self.waiting += 1
+        try:
+            async with self.wait_lock:
+                while not self.bucket.try_take():
+                    await asyncio.sleep(self.bucket.wait_time())
+        finally:
+            self.waiting -= 1
+        self.stats(message).required += 1
+        self.spend(message)
+
+    def record(self, message, violated):
+        '''
+        Feeds the outcome of a sampled message back into its channel's violation rate.
+        '''
+        stats = self.stats(message)
+        stats.violations += violated
+        stats.violation_rate += self.decay * (violated - stats.violation_rate)
+
+    def coverage(self):
+        '''
+        The fraction of seen channel messages that were actually scored.
+        '''
+        seen = sum(stats.seen for stats in self.channels.values())
+        scored = sum(stats.scored for stats in self.channels.values())
+        return scored / seen if seen else 1.0
+
+    def report(self, channel_names=None):
+        channel_names = channel_names or {}
+        s = f"Perspective coverage {self.coverage():.0%}, budget {self.bucket.rate:g} QPS, "
+        s += f"{self.reserve:.0%} reserved for fully covered channels\n"
+        for guild_id, spend in self.guild_spend.items():
+            s += f"Guild `{guild_id}`: {spend} calls\n"
+        for (guild_id, channel_id), stats in self.channels.items():
+            name = channel_names.get(channel_id, channel_id)
+            covered = stats.scored / stats.seen if stats.seen else 1.0
+            s += f"`{name}`: sampling {self.sample_rate(stats):.0%}, coverage {covered:.0%}, "
+            s += f"{stats.scored} scored, {stats.sampled_out} sampled out, {stats.throttled} throttled, "
+            s += f"{stats.required} scored for reports, "
+            s += f"violation rate {stats.violation_rate:.1%}\n"
+        return s
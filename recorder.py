@@ -0,0 +1,44 @@
+# recorder.py
+import json
+import queue
+import threading
+import time
+
+
+class EventRecorder:
+    '''
+    Appends the messages the bot handles to a JSONL file that `loadtest.py --replay` can play back.
+    Each line is `{t, kind, author, id, content}` plus the guild and channel ids, so links to reported
+    messages can be mapped onto the load test's fake guild. Lines are written by a background thread.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.start = time.monotonic()
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+
+    def record(self, kind, message):
+        self.queue.put({
+            "t": time.monotonic() - self.start,
+            "kind": kind,
+            "author": message.author.id,
+            "id": message.id,
+            "content": message.content,
+            "guild": message.guild.id if message.guild else None,
+            "channel": message.channel.id,
+        })
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def _write(self):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            while True:
+                event = self.queue.get()
+                if event is None:
+                    return
+                f.write(json.dumps(event, ensure_ascii=False) + "\n")
+                if self.queue.empty():
+                    f.flush()
@@ -82,8 +82,8 @@ class Report:
 		return ["Please type your ticket number below"]
 
 	async def get_ticket(self, message):
-		for report in self.client.completed_reports + self.client.reports:
-			if str(report.reported_message.id) == message.content:
+		for report in self.client.completed_reports + self.client.moderation_queue():
+			if report.reported_message and str(report.reported_message.id) == message.content:
 				self.reported_message = report.reported_message
 				self.severity = report.severity
 				for action in report.actions:
@@ -125,14 +125,28 @@ class Report:
 		channel = guild.get_channel(int(m.group(2)))
 		if not channel:
 			return ["It seems this channel was deleted or never existed. Please try again or say `cancel` to cancel."]
+
+		# Most reported messages were just seen by the bot, so try the cache before going over REST
+		cached = self.client.message_cache.get(guild.id, channel.id, int(m.group(3)))
+		if cached:
+			return await self.message_identified(cached.message, cached.eval)
+
 		try:
 			message = await channel.fetch_message(int(m.group(3)))
 		except discord.errors.NotFound:
 			return ["It seems this message was deleted or never existed. Please try again or say `cancel` to cancel."]
-		# Here we've found the message - it's up to you to decide what to do next!
+		return await self.message_identified(message)
+
+	'''
+	This function records the reported message, scoring it if it hasn't been scored yet, and asks for the abuse type
+	'''
+	async def message_identified(self, message, eval=None):
 		self.state = State.MESSAGE_IDENTIFIED
 		self.reported_message = message
-		eval = self.client.eval_text(message)
+		if eval is None:
+			await self.client.quota.acquire_required(message)
+			eval = self.client.eval_text(message)
+			self.client.message_cache.put(message, eval)
 		self.severity = eval[0]
 		self.type = eval[1]
 		self.type = eval[2]
@@ -293,7 +307,7 @@ class Report:
 				msg += f"Your ticket number is `{self.reported_message.id}`"
 				await self.reported_message.author.send(msg)
 
-		for report in self.client.reports:
+		for report in self.client.moderation_queue():
 			if report.reported_message.id == self.reported_message.id:
 				if report.reporter != self.client.user:
 					await report.reporter.send(f"Your report numbered `{report.reported_message.id}` has been moderated")
@@ -339,7 +353,7 @@ class Report:
 	Since it needs the current time, it can't just be a member
 	'''
 	def get_priority(self):
-		reports = [report for report in self.client.reports if report.reported_message.id == self.reported_message.id]
+		reports = [report for report in self.client.moderation_queue() if report.reported_message.id == self.reported_message.id]
 		age = (datetime.now() - self.creation_time).total_seconds() / 3600  # Hours since report creation
 		return (age + self.severity) * len(reports)
 
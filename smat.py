@@ -7,12 +7,30 @@ def generate_query(term, limit, site, start, end):
 	end_time = end.strftime("%Y-%m-%dT%H:%M:%S.%f")
 	return "https://api.smat-app.com/content?term={}&limit={}&site={}&since={}&until={}&esquery=false".format(term, limit, site, start_time, end_time)
 
-def main():
-	url = generate_query("storm", 10, "reddit", datetime(2020, 1, 1), datetime(2021, 1, 1))
+def fetch_posts(term, limit, site, start, end):
+	url = generate_query(term, limit, site, start, end)
 	r = requests.get(url)
 	if not r.ok:
 		print("Request failed with code {}".format(r.status_code))
-	posts = json.loads(r.content)
+		return []
+	return unwrap_posts(json.loads(r.content))
+
+def unwrap_posts(response):
+	# The API hands back raw elasticsearch results; older dumps are a plain list of posts
+	if isinstance(response, dict):
+		if "hits" not in response:
+			print("Unexpected response: {}".format(response))
+			return []
+		response = response["hits"]
+		if isinstance(response, dict):
+			response = response.get("hits", [])
+	if not isinstance(response, list):
+		print("Unexpected response: {}".format(response))
+		return []
+	return [post.get("_source", post) for post in response if isinstance(post, dict)]
+
+def main():
+	posts = fetch_posts("storm", 10, "reddit", datetime(2020, 1, 1), datetime(2021, 1, 1))
 	print(posts)
 
 if __name__ == "__main__":
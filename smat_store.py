@@ -0,0 +1,450 @@
+'''
+A local columnar store for posts pulled from SMAT.
+
+Posts are partitioned into one directory per site and UTC day. Each ingest appends a new immutable segment
+to the partitions it touches, and partitions with too many segments are compacted into one:
+
+    <root>/<site>/<YYYY-MM-DD>/seg-<NNNNNN>/
+        time.bin       float64 post timestamps, sorted
+        text.bin       utf-8 post text, concatenated
+        text.idx       uint64 offsets into text.bin, one more than there are rows
+        ids.bin        utf-8 post ids by row, concatenated
+        ids.idx        uint64 offsets into ids.bin
+        postings.bin   uint32 row numbers, grouped by term and sorted within each term
+        terms.keys     utf-8 terms in sorted order, concatenated
+        terms.kidx     uint64 offsets into terms.keys
+        terms.vals     uint64 [offset, length] into postings.bin for each term
+        byid.keys      utf-8 post ids in sorted order, concatenated
+        byid.kidx      uint64 offsets into byid.keys
+        byid.vals      uint64 row of each post id
+
+Every file is memory mapped on first use, so a window query only bisects the time column, the term table
+and the posting list of the term. Nothing is parsed.
+'''
+import hashlib
+import logging
+import math
+import mmap
+import os
+import re
+import shutil
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta, timezone
+
+from smat import fetch_posts
+
+logger = logging.getLogger('smat')
+
+TIME_FIELDS = ["created_utc", "created_at", "createdAt", "date", "timestamp"]
+TIME_FORMATS = ["%a %b %d %H:%M:%S %z %Y", "%a, %d %b %Y %H:%M:%S %z", "%Y-%m-%d %H:%M:%S"]
+MS_EPOCH_CUTOFF = 1e11
+TEXT_FIELDS = ["body", "title", "selftext", "text", "content"]
+ID_FIELDS = ["id", "_id", "uuid"]
+WORD_RE = re.compile(r"\w+")
+
+
+def parse_epoch(value):
+	if not math.isfinite(value):
+		raise ValueError("Non-finite time {!r}".format(value))
+	# Some sites give epochs in milliseconds; in seconds these would be past the year 5000
+	if abs(value) >= MS_EPOCH_CUTOFF:
+		value /= 1000
+	return value
+
+
+def parse_time(value):
+	if isinstance(value, (int, float)):
+		return parse_epoch(float(value))
+	try:
+		number = float(value)
+	except ValueError:
+		pass
+	else:
+		return parse_epoch(number)
+	try:
+		return to_timestamp(datetime.fromisoformat(value.replace("Z", "+00:00")))
+	except ValueError:
+		pass
+	# e.g. Twitter's "Wed Oct 10 20:19:24 +0000 2018"
+	for time_format in TIME_FORMATS:
+		try:
+			return to_timestamp(datetime.strptime(value, time_format))
+		except ValueError:
+			pass
+	raise ValueError("Unrecognised time {!r}".format(value))
+
+
+def post_time(post):
+	for field in TIME_FIELDS:
+		value = post.get(field)
+		if isinstance(value, (int, float, str)):
+			return parse_time(value)
+	raise ValueError("Post has no recognisable time field: {}".format(sorted(post)))
+
+
+def post_text(post):
+	return "\n".join(str(post[field]) for field in TEXT_FIELDS if post.get(field))
+
+
+def post_id(post):
+	for field in ID_FIELDS:
+		if post.get(field) is not None:
+			return str(post[field])
+	key = "{}:{}".format(post_time(post), post_text(post))
+	return hashlib.md5(key.encode("utf-8")).hexdigest()
+
+
+def tokenize(text):
+	return set(WORD_RE.findall(text.lower()))
+
+
+def to_timestamp(dt):
+	# SMAT queries use naive datetimes, which are treated as UTC
+	if dt.tzinfo is None:
+		dt = dt.replace(tzinfo=timezone.utc)
+	return dt.timestamp()
+
+
+def day_of(timestamp):
+	return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%d")
+
+
+class SortedKeys:
+	'''
+	A sequence view over concatenated, sorted byte strings, so `bisect` can search them in place.
+	'''
+	def __init__(self, data, offsets):
+		self.data = data
+		self.offsets = offsets
+
+	def __len__(self):
+		return len(self.offsets) - 1
+
+	def __getitem__(self, i):
+		return bytes(self.data[self.offsets[i]:self.offsets[i + 1]])
+
+
+class Segment:
+	'''
+	A read-only, memory mapped view of one immutable segment of a site/day partition.
+	'''
+	def __init__(self, path):
+		self.path = path
+		self.columns = {}
+		self._maps = []
+		self.readers = 0  # Queries currently iterating this segment
+
+	def column(self, name, typecode):
+		if name not in self.columns:
+			with open(os.path.join(self.path, name), "rb") as f:
+				if os.fstat(f.fileno()).st_size == 0:
+					self.columns[name] = memoryview(b"").cast(typecode)
+				else:
+					mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+					self._maps.append(mm)
+					self.columns[name] = memoryview(mm).cast(typecode)
+		return self.columns[name]
+
+	@property
+	def time(self):
+		return self.column("time.bin", "d")
+
+	def __len__(self):
+		return len(self.time)
+
+	def close(self):
+		# Views handed out by rows() keep their maps alive until they are garbage collected
+		for view in list(self.columns.values()) + self._maps:
+			try:
+				view.release() if isinstance(view, memoryview) else view.close()
+			except BufferError:
+				pass
+		self.columns = {}
+		self._maps = []
+
+	def lookup(self, table, key, width):
+		'''
+		Bisects a sorted key table for `key` and returns its `width` values, or None if it isn't there.
+		'''
+		keys = SortedKeys(self.column(table + ".keys", "B"), self.column(table + ".kidx", "Q"))
+		key = key.encode("utf-8")
+		i = bisect_left(keys, key)
+		if i == len(keys) or keys[i] != key:
+			return None
+		return self.column(table + ".vals", "Q")[i * width:(i + 1) * width]
+
+	def has_id(self, id):
+		return self.lookup("byid", id, 1) is not None
+
+	def rows(self, term=None, start=None, end=None):
+		'''
+		Returns the row numbers in [start, end) that contain `term`, as a range or a memoryview.
+		'''
+		lo = 0 if start is None else bisect_left(self.time, start)
+		hi = len(self.time) if end is None else bisect_left(self.time, end)
+		if term is None:
+			return range(lo, hi)
+		found = self.lookup("terms", term, 2)
+		if found is None:
+			return range(0)
+		offset, length = found
+		posting = self.column("postings.bin", "I")[offset:offset + length]
+		return posting[bisect_left(posting, lo):bisect_left(posting, hi)]
+
+	def post(self, row):
+		text, text_idx = self.column("text.bin", "B"), self.column("text.idx", "Q")
+		ids, ids_idx = self.column("ids.bin", "B"), self.column("ids.idx", "Q")
+		return {
+			"id": bytes(ids[ids_idx[row]:ids_idx[row + 1]]).decode("utf-8"),
+			"time": self.time[row],
+			"text": bytes(text[text_idx[row]:text_idx[row + 1]]).decode("utf-8"),
+		}
+
+
+def key_table(name, entries):
+	'''
+	Builds the files of a sorted key table from (key, values) pairs.
+	'''
+	entries = sorted((key.encode("utf-8"), values) for key, values in entries)
+	keys = bytearray()
+	offsets = array("Q", [0])
+	values = array("Q")
+	for key, vals in entries:
+		keys += key
+		offsets.append(len(keys))
+		values.extend(vals)
+	return {name + ".keys": bytes(keys), name + ".kidx": offsets.tobytes(), name + ".vals": values.tobytes()}
+
+
+def write_segment(path, posts):
+	'''
+	Writes (id, time, text) tuples, sorted by time, as a segment at `path`.
+	'''
+	times = array("d")
+	text_idx = array("Q", [0])
+	ids_idx = array("Q", [0])
+	text = bytearray()
+	ids = bytearray()
+	index = {}
+	for row, (id, timestamp, body) in enumerate(posts):
+		times.append(timestamp)
+		text += body.encode("utf-8")
+		text_idx.append(len(text))
+		ids += id.encode("utf-8")
+		ids_idx.append(len(ids))
+		for term in tokenize(body):
+			index.setdefault(term, array("I")).append(row)
+
+	postings = array("I")
+	terms = []
+	for term, rows in index.items():
+		terms.append((term, (len(postings), len(rows))))
+		postings.extend(rows)
+
+	columns = {
+		"time.bin": times.tobytes(),
+		"text.bin": bytes(text),
+		"text.idx": text_idx.tobytes(),
+		"ids.bin": bytes(ids),
+		"ids.idx": ids_idx.tobytes(),
+		"postings.bin": postings.tobytes(),
+	}
+	columns.update(key_table("terms", terms))
+	columns.update(key_table("byid", ((id, (row,)) for row, (id, _, _) in enumerate(posts))))
+
+	# Build the segment next to its final name so a reader never sees half a segment
+	tmp_path = os.path.join(os.path.dirname(path), "." + os.path.basename(path) + ".tmp")
+	shutil.rmtree(tmp_path, ignore_errors=True)
+	os.makedirs(tmp_path)
+	for name, data in columns.items():
+		with open(os.path.join(tmp_path, name), "wb") as f:
+			f.write(data)
+	os.rename(tmp_path, path)
+
+
+class SmatStore:
+	'''
+	Ingests SMAT posts into site/day partitions and answers term and time window queries locally.
+	'''
+	def __init__(self, root, max_segments=16):
+		self.root = root
+		self.max_segments = max_segments  # Compact a partition once an ingest leaves it with more segments
+		self._segments = {}  # Map from (site, day) to that partition's open segments, oldest first
+		self._retired = []  # Compacted-away segments, deleted once no query is reading them
+
+	def close(self):
+		for segments in self._segments.values():
+			for segment in segments:
+				segment.close()
+		self._segments = {}
+		self._collect(force=True)
+
+	def _collect(self, force=False):
+		live = []
+		for segment in self._retired:
+			if segment.readers and not force:
+				live.append(segment)
+				continue
+			segment.close()
+			shutil.rmtree(segment.path, ignore_errors=True)
+		self._retired = live
+
+	def sites(self):
+		if not os.path.isdir(self.root):
+			return []
+		return sorted(d for d in os.listdir(self.root) if os.path.isdir(os.path.join(self.root, d)))
+
+	def days(self, site):
+		path = os.path.join(self.root, site)
+		if not os.path.isdir(path):
+			return []
+		return sorted(d for d in os.listdir(path) if os.path.isdir(os.path.join(path, d)))
+
+	def segments(self, site, day):
+		key = (site, day)
+		if key not in self._segments:
+			path = os.path.join(self.root, site, day)
+			names = sorted(d for d in os.listdir(path) if d.startswith("seg-")) if os.path.isdir(path) else []
+			self._segments[key] = [Segment(os.path.join(path, name)) for name in names]
+		return self._segments[key]
+
+	def _next_segment_path(self, site, day):
+		segments = self.segments(site, day)
+		seq = int(os.path.basename(segments[-1].path)[4:]) + 1 if segments else 0
+		return os.path.join(self.root, site, day, "seg-{:06d}".format(seq))
+
+	def ingest(self, site, posts):
+		'''
+		Appends raw SMAT posts for `site` as new segments. Posts already in the store (by id) are skipped, as
+		are posts without a readable time. Returns the number of posts written.
+		'''
+		by_day = {}
+		skipped = 0
+		for post in posts:
+			try:
+				timestamp = post_time(post)
+				day = day_of(timestamp)
+			except (ValueError, OverflowError, OSError) as e:
+				skipped += 1
+				logger.debug("Skipping post: %s", e)
+				continue
+			by_day.setdefault(day, {})[post_id(post)] = (timestamp, post_text(post))
+		if skipped:
+			logger.warning("Skipped %d posts without a readable time", skipped)
+
+		written = 0
+		for day, new_posts in by_day.items():
+			segments = self.segments(site, day)
+			rows = [(id, t, text) for id, (t, text) in new_posts.items()
+					if not any(segment.has_id(id) for segment in segments)]
+			if not rows:
+				continue
+			rows.sort(key=lambda row: (row[1], row[0]))
+			path = self._next_segment_path(site, day)
+			os.makedirs(os.path.dirname(path), exist_ok=True)
+			write_segment(path, rows)
+			segments.append(Segment(path))
+			written += len(rows)
+			if len(segments) > self.max_segments:
+				self.compact(site, day)
+		return written
+
+	def compact(self, site, day):
+		'''
+		Merges all segments of a partition into one.
+		'''
+		self._collect()
+		segments = self.segments(site, day)
+		if len(segments) <= 1:
+			return
+		merged = {}
+		for segment in segments:
+			for row in range(len(segment)):
+				post = segment.post(row)
+				merged[post["id"]] = (post["time"], post["text"])
+		rows = sorted(((id, t, text) for id, (t, text) in merged.items()), key=lambda row: (row[1], row[0]))
+		path = self._next_segment_path(site, day)
+		write_segment(path, rows)
+		self._segments[(site, day)] = [Segment(path)]
+		# Queries may still be reading the old segments, so move them out of the partition listing
+		# and only delete them once those queries are done
+		for segment in segments:
+			retired_path = os.path.join(os.path.dirname(segment.path), ".retired-" + os.path.basename(segment.path))
+			os.rename(segment.path, retired_path)
+			segment.path = retired_path
+			self._retired.append(segment)
+		self._collect()
+
+	def compact_all(self):
+		for site in self.sites():
+			for day in self.days(site):
+				self.compact(site, day)
+
+	def backfill(self, term, site, start, end, limit=10000):
+		'''
+		Pulls posts from SMAT through `generate_query` and ingests them. Returns the number of posts written.
+		'''
+		return self.ingest(site, fetch_posts(term, limit, site, start, end))
+
+	def _matches(self, term=None, site=None, start=None, end=None):
+		term = term.lower() if term else None
+		lo = to_timestamp(start) if start else None
+		hi = to_timestamp(end) if end else None
+		for s in ([site] if site else self.sites()):
+			days = self.days(s)
+			first = bisect_left(days, day_of(lo)) if lo is not None else 0
+			last = bisect_right(days, day_of(hi - 1e-6)) if hi is not None else len(days)
+			for day in days[first:last]:
+				# Hold every segment of the day until we've read it, in case a compaction retires them meanwhile
+				segments = list(self.segments(s, day))
+				for segment in segments:
+					segment.readers += 1
+				try:
+					for segment in segments:
+						yield s, segment, segment.rows(term, lo, hi)
+				finally:
+					for segment in segments:
+						segment.readers -= 1
+
+	def count(self, term=None, site=None, start=None, end=None):
+		'''
+		Counts posts in [start, end) containing `term`, without reading any post text.
+		'''
+		return sum(len(rows) for _, _, rows in self._matches(term, site, start, end))
+
+	def query(self, term=None, site=None, start=None, end=None):
+		'''
+		Yields posts in [start, end) containing `term` as dicts with `site`, `id`, `time` and `text`.
+		Posts come out in time order within each segment.
+		'''
+		for s, segment, rows in self._matches(term, site, start, end):
+			for row in rows:
+				post = segment.post(row)
+				post["site"] = s
+				yield post
+
+	def histogram(self, term=None, site=None, start=None, end=None, bucket=timedelta(days=1)):
+		'''
+		Counts matching posts per `bucket` starting at `start`. Useful for threshold studies.
+		'''
+		counts = {}
+		origin = to_timestamp(start) if start else 0
+		width = bucket.total_seconds()
+		for _, segment, rows in self._matches(term, site, start, end):
+			time = segment.time
+			for row in rows:
+				b = int((time[row] - origin) // width)
+				counts[b] = counts.get(b, 0) + 1
+		return [(datetime.fromtimestamp(origin + b * width, timezone.utc), counts[b]) for b in sorted(counts)]
+
+
+def main():
+	store = SmatStore("smat_data")
+	written = store.backfill("storm", "reddit", datetime(2020, 1, 1), datetime(2021, 1, 1))
+	print("Ingested {} posts".format(written))
+	print(store.count("storm", "reddit", datetime(2020, 6, 1), datetime(2020, 7, 1)))
+
+
+if __name__ == "__main__":
+	main()
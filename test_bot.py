@@ -0,0 +1,142 @@
+# test_bot.py
+import asyncio
+import unittest
+
+from types import SimpleNamespace
+
+import constants
+import loadtest
+from message_cache import MessageCache
+from report import Report, State
+
+
+class DMSessionTest(unittest.IsolatedAsyncioTestCase):
+    '''
+    Runs interleaved DM reporting flows through ModBot with fakes whose Discord calls yield,
+    so handlers for different users overlap the way they do on the gateway.
+    '''
+    async def asyncSetUp(self):
+        self.world = loadtest.World(network_latency=0.002)
+        self.bot = loadtest.HarnessBot(self.world, "http://127.0.0.1:1", 1000)
+        await self.bot.on_ready()
+
+    def seed_channel(self, events):
+        # Reported messages come from the cache with a score, so no Perspective call is made
+        for event in events:
+            if event["kind"] == "channel":
+                self.bot.message_cache.put(self.world.make_message(event), (0.0, "auto", "auto"))
+        return [event for event in events if event["kind"] != "channel"]
+
+    async def test_interleaved_reporters_keep_their_reports(self):
+        events = loadtest.reporter_events(60)
+        dms = self.seed_channel(events)
+        latencies, errors, _, _ = await loadtest.replay(self.bot, dms, speed=1.0)
+        self.assertEqual(errors, [])
+        self.assertEqual(loadtest.check_reports(self.bot, events), [])
+        # The moderator works the queue while reports are still being filled in
+        moderated = [report for report in self.bot.completed_reports if report.reported_message is not None]
+        self.assertGreater(len(moderated), 0)
+        self.assertTrue(all(constants.MOD_M_HIDE in report.actions for report in moderated))
+        self.assertEqual(len(self.bot.reports) + len(moderated), 60)
+        self.assertEqual(len(self.bot.completed_reports) - len(moderated), 20)
+        self.assertEqual(self.bot.dm_sessions, {})
+
+    async def test_help_waits_for_earlier_messages(self):
+        replies = []
+        user = self.world.user(loadtest.FIRST_USER_ID)
+        channel = self.world.dm_channels[user.id]
+        send = channel.send
+
+        async def recording_send(content):
+            # The reply to `report` is slow, so a `help` that skips the queue would be answered first
+            if content.startswith("Thank you"):
+                await asyncio.sleep(0.05)
+            replies.append(content.split("\n")[0])
+            return await send(content)
+
+        channel.send = recording_send
+        events = [{"t": 0.0, "kind": "dm", "author": user.id, "id": i + 1, "content": content}
+                  for i, content in enumerate(["report", "help", "cancel"])]
+        await loadtest.replay(self.bot, events, speed=1.0)
+        self.assertTrue(replies[0].startswith("Thank you for starting the reporting process"))
+        self.assertTrue(replies[1].startswith("Use the `report` command"))
+        self.assertEqual(replies[2], "Report cancelled.")
+        self.assertEqual(self.bot.reports, [])
+        self.assertEqual(self.bot.completed_reports[0].state, State.REPORT_COMPLETE)
+
+
+class MessageCacheTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.world = loadtest.World()
+        self.bot = loadtest.HarnessBot(self.world, "http://127.0.0.1:1", 1000)
+        self.bot.mod_channels[loadtest.GUILD_ID] = self.world.mod_channel
+
+    def message(self, id, content="hello"):
+        return self.world.make_message({"kind": "channel", "author": loadtest.FIRST_USER_ID, "id": id, "content": content})
+
+    def link(self, id, channel_id=loadtest.CHANNEL_ID):
+        return f"https://discord.com/channels/{loadtest.GUILD_ID}/{channel_id}/{id}"
+
+    def test_lru_eviction(self):
+        cache = MessageCache(3)
+        for i in range(3):
+            cache.put(self.message(i))
+        cache.get(loadtest.GUILD_ID, loadtest.CHANNEL_ID, 0)
+        cache.put(self.message(3))
+        self.assertEqual(len(cache), 3)
+        self.assertIsNone(cache.get(loadtest.GUILD_ID, loadtest.CHANNEL_ID, 1))
+        self.assertIsNotNone(cache.get(loadtest.GUILD_ID, loadtest.CHANNEL_ID, 0))
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    async def test_gateway_events_invalidate(self):
+        cache = self.bot.message_cache
+        for i in range(5):
+            cache.put(self.message(i), (0.1, "auto", "auto"))
+        payload = SimpleNamespace(guild_id=loadtest.GUILD_ID, channel_id=loadtest.CHANNEL_ID)
+        await self.bot.on_raw_message_delete(SimpleNamespace(message_id=0, **vars(payload)))
+        await self.bot.on_raw_message_edit(SimpleNamespace(message_id=1, **vars(payload)))
+        await self.bot.on_raw_bulk_message_delete(SimpleNamespace(message_ids={2, 3}, **vars(payload)))
+        self.assertEqual([key[2] for key in cache.entries], [4])
+        await self.bot.on_guild_channel_delete(self.world.channel)
+        self.assertEqual(len(cache), 0)
+
+    async def test_read_message_uses_cache(self):
+        message = self.message(7, "you are stupid")
+        self.bot.message_cache.put(message, (0.5, "auto", "auto"))
+
+        async def fetch_message(id):
+            raise AssertionError("fetched over REST")
+
+        def eval_text(message):
+            raise AssertionError("scored again")
+
+        self.world.channel.fetch_message = fetch_message
+        self.bot.eval_text = eval_text
+        report = Report(self.bot, self.world.user(loadtest.FIRST_USER_ID + 1))
+        link = self.message(8, self.link(7))
+        replies = await report.read_message(link)
+        self.assertEqual(report.state, State.MESSAGE_IDENTIFIED)
+        self.assertIs(report.reported_message, message)
+        self.assertEqual(report.severity, 0.5)
+        self.assertIn("you are stupid", replies[0])
+
+    async def test_read_message_miss_fetches_and_caches(self):
+        message = self.message(7)
+        scored = []
+        self.bot.eval_text = lambda message: scored.append(message) or (0.3, "auto", "auto")
+        report = Report(self.bot, self.world.user(loadtest.FIRST_USER_ID + 1))
+        await report.read_message(self.message(8, self.link(7)))
+        self.assertEqual(scored, [message])
+        self.assertEqual(self.bot.message_cache.get(loadtest.GUILD_ID, loadtest.CHANNEL_ID, 7).eval[0], 0.3)
+
+    async def test_cached_message_in_deleted_channel_is_rejected(self):
+        self.bot.message_cache.put(self.message(7), (0.5, "auto", "auto"))
+        self.world.guild.text_channels.remove(self.world.channel)
+        report = Report(self.bot, self.world.user(loadtest.FIRST_USER_ID + 1))
+        replies = await report.read_message(self.message(8, self.link(7)))
+        self.assertIn("channel was deleted", replies[0])
+        self.assertIsNone(report.reported_message)
+
+
+if __name__ == "__main__":
+    unittest.main()
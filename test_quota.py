@@ -0,0 +1,136 @@
+# test_quota.py
+import asyncio
+import unittest
+
+from types import SimpleNamespace
+from unittest import mock
+
+from quota import QuotaBudgeter, TokenBucket
+
+
+def message(channel_id, guild_id=1):
+    return SimpleNamespace(guild=SimpleNamespace(id=guild_id), channel=SimpleNamespace(id=channel_id))
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class QuotaTestCase(unittest.IsolatedAsyncioTestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        patcher = mock.patch("quota.time.monotonic", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class TokenBucketTest(QuotaTestCase):
+    def test_starts_full_and_empties(self):
+        bucket = TokenBucket(2)
+        self.assertTrue(bucket.try_take())
+        self.assertTrue(bucket.try_take())
+        self.assertFalse(bucket.try_take())
+        self.assertAlmostEqual(bucket.wait_time(), 0.5)
+
+    def test_refills_at_rate_up_to_capacity(self):
+        bucket = TokenBucket(2, capacity=3)
+        for _ in range(3):
+            bucket.try_take()
+        self.clock.now = 1.0
+        self.assertAlmostEqual(bucket.wait_time(3), 0.5)
+        self.assertTrue(bucket.try_take(2))
+        self.assertFalse(bucket.try_take())
+        self.clock.now = 100.0
+        self.assertTrue(bucket.available(3))
+        self.assertFalse(bucket.available(4))
+
+    def test_slow_rate_still_bursts_one(self):
+        bucket = TokenBucket(0.25)
+        self.assertTrue(bucket.try_take())
+        self.assertFalse(bucket.try_take())
+        self.assertAlmostEqual(bucket.wait_time(), 4.0)
+
+
+class QuotaBudgeterTest(QuotaTestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch("quota.random.random", return_value=0.5)
+        self.random = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_sample_rate_decays_and_recovers(self):
+        quota = QuotaBudgeter(qps=10, min_sample_rate=0.1, high_risk_rate=0.05, decay=0.1)
+        stats = quota.stats(message(1))
+        self.assertEqual(quota.sample_rate(stats), 1.0)
+        rates = []
+        for _ in range(40):
+            quota.record(message(1), False)
+            rates.append(quota.sample_rate(stats))
+        self.assertEqual(rates, sorted(rates, reverse=True))
+        self.assertEqual(rates[-1], 0.1)
+        quota.record(message(1), True)
+        self.assertEqual(quota.sample_rate(stats), 1.0)
+
+    def test_sampled_out_messages_spend_nothing(self):
+        quota = QuotaBudgeter(qps=10)
+        quota.stats(message(1)).violation_rate = 0.0
+        self.assertFalse(quota.acquire(message(1)))
+        self.random.return_value = 0.05
+        self.assertTrue(quota.acquire(message(1)))
+        stats = quota.stats(message(1))
+        self.assertEqual((stats.seen, stats.sampled_out, stats.scored), (2, 1, 1))
+        self.assertEqual(quota.guild_spend, {1: 1})
+
+    def test_acquire_throttles_while_required_calls_wait(self):
+        quota = QuotaBudgeter(qps=10)
+        quota.waiting = 1
+        self.assertFalse(quota.acquire(message(1)))
+        quota.waiting = 0
+        self.assertTrue(quota.acquire(message(1)))
+        stats = quota.stats(message(1))
+        self.assertEqual((stats.throttled, stats.scored), (1, 1))
+
+    def test_quiet_channels_leave_the_reserve(self):
+        quota = QuotaBudgeter(qps=4, reserve=0.5)
+        quota.stats(message(2)).violation_rate = 0.0
+        self.random.return_value = 0.0
+        # The quiet channel only gets its half of the burst, the rest stays for the fully covered channel
+        self.assertEqual([quota.acquire(message(2)) for _ in range(4)], [True, True, False, False])
+        self.assertEqual([quota.acquire(message(1)) for _ in range(3)], [True, True, False])
+        self.clock.now = 1.0
+        self.assertEqual([quota.acquire(message(2)) for _ in range(3)], [True, True, False])
+        self.assertEqual([quota.acquire(message(1)) for _ in range(3)], [True, True, False])
+
+    async def test_required_calls_wait_in_order(self):
+        quota = QuotaBudgeter(qps=1)
+        quota.acquire(message(1))
+        sleep = asyncio.sleep
+
+        async def fake_sleep(delay):
+            self.clock.now += delay
+            await sleep(0)
+
+        done = []
+
+        async def require(i):
+            await quota.acquire_required(message(2))
+            done.append((i, self.clock.now))
+
+        with mock.patch("quota.asyncio.sleep", fake_sleep):
+            tasks = [asyncio.create_task(require(i)) for i in range(3)]
+            await sleep(0)
+            self.assertEqual(quota.waiting, 3)
+            self.assertFalse(quota.acquire(message(1)))
+            await asyncio.gather(*tasks)
+        self.assertEqual(done, [(0, 1.0), (1, 2.0), (2, 3.0)])
+        self.assertEqual(quota.waiting, 0)
+        self.assertEqual(quota.stats(message(2)).required, 3)
+        self.assertEqual(quota.guild_spend, {1: 4})
+
+
+if __name__ == "__main__":
+    unittest.main()
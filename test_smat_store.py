@@ -0,0 +1,114 @@
+# test_smat_store.py
+import random
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta, timezone
+
+from smat_store import SmatStore, tokenize
+
+WORDS = ["storm", "rain", "sun", "wind", "snow"]
+START = datetime(2020, 3, 1)
+
+
+def make_posts(n, prefix="", days=5, seed=0):
+    rnd = random.Random(seed)
+    base = START.replace(tzinfo=timezone.utc).timestamp()
+    return [{"id": f"{prefix}{i}", "created_utc": base + rnd.random() * 86400 * days,
+             "body": " ".join(rnd.choices(WORDS, k=4))} for i in range(n)]
+
+
+class SmatStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.store = SmatStore(self.root, max_segments=4)
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.root)
+
+    def brute(self, posts, term=None, start=None, end=None):
+        lo = start.replace(tzinfo=timezone.utc).timestamp() if start else float("-inf")
+        hi = end.replace(tzinfo=timezone.utc).timestamp() if end else float("inf")
+        return sorted(str(p["id"]) for p in posts
+                      if lo <= p["created_utc"] < hi and (term is None or term in tokenize(p["body"])))
+
+    def windows(self):
+        # Windows that start and end part way through a day, span several days or are open ended
+        return [
+            (None, None, None),
+            ("storm", None, None),
+            ("storm", START + timedelta(hours=13), START + timedelta(days=2, hours=5)),
+            ("rain", START + timedelta(days=1), START + timedelta(days=2)),
+            (None, START + timedelta(days=3, minutes=1), None),
+            ("snow", None, START + timedelta(hours=30)),
+            ("hail", None, None),
+        ]
+
+    def check_against(self, posts):
+        for term, start, end in self.windows():
+            expected = self.brute(posts, term, start, end)
+            self.assertEqual(self.store.count(term, "reddit", start, end), len(expected))
+            self.assertEqual(sorted(p["id"] for p in self.store.query(term, "reddit", start, end)), expected)
+            if start:
+                histogram = self.store.histogram(term, "reddit", start, end, timedelta(hours=6))
+                self.assertEqual(sum(count for _, count in histogram), len(expected))
+                for bucket_start, count in histogram:
+                    bucket_end = bucket_start.replace(tzinfo=None) + timedelta(hours=6)
+                    self.assertEqual(count, len(self.brute(posts, term, max(start, bucket_start.replace(tzinfo=None)),
+                                                           min(end, bucket_end) if end else bucket_end)))
+
+    def test_overlapping_batches_skip_duplicates(self):
+        posts = make_posts(300)
+        self.assertEqual(self.store.ingest("reddit", posts[:200]), 200)
+        self.assertEqual(self.store.ingest("reddit", posts[100:]), 100)
+        self.assertEqual(self.store.ingest("reddit", posts), 0)
+        self.assertEqual(self.store.count(site="reddit"), 300)
+
+    def test_queries_match_brute_force(self):
+        posts = make_posts(500)
+        for i in range(0, 500, 50):
+            self.store.ingest("reddit", posts[i:i + 50])
+        self.check_against(posts)
+
+    def test_results_survive_compaction_and_reopening(self):
+        posts = make_posts(500)
+        for i in range(0, 500, 100):
+            self.store.ingest("reddit", posts[i:i + 100])
+        self.store.compact_all()
+        for day in self.store.days("reddit"):
+            self.assertEqual(len(self.store.segments("reddit", day)), 1)
+        self.check_against(posts)
+        self.store.close()
+        self.store = SmatStore(self.root)
+        self.check_against(posts)
+
+    def test_query_during_compaction(self):
+        posts = make_posts(200, days=1)
+        for i in range(0, 100, 25):
+            self.store.ingest("reddit", posts[i:i + 25])
+        query = self.store.query("storm", "reddit")
+        first = next(query)
+        # The fifth segment pushes the day over max_segments and compacts the segments being read
+        self.store.ingest("reddit", posts[100:])
+        seen = [first["id"]] + [p["id"] for p in query]
+        self.assertEqual(sorted(seen), self.brute(posts[:100], "storm"))
+        self.assertEqual(self.store.count("storm", "reddit"), len(self.brute(posts, "storm")))
+
+    def test_unreadable_times_are_skipped(self):
+        posts = [
+            {"id": "ms", "timestamp": 1600000000000, "text": "storm"},
+            {"id": "twitter", "created_at": "Wed Oct 10 20:19:24 +0000 2018", "text": "storm"},
+            {"id": "nan", "created_utc": "nan", "text": "storm"},
+            {"id": "huge", "created_utc": 1e300, "text": "storm"},
+            {"id": "garbage", "created_at": "yesterday", "text": "storm"},
+            {"id": "none", "text": "storm"},
+        ]
+        with self.assertLogs("smat", "WARNING"):
+            self.assertEqual(self.store.ingest("twitter", posts), 2)
+        times = {p["id"]: p["time"] for p in self.store.query("storm")}
+        self.assertEqual(times, {"ms": 1600000000.0, "twitter": 1539202764.0})
+
+
+if __name__ == "__main__":
+    unittest.main()